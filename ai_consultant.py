@@ -7,8 +7,16 @@ Now with LLM integration for natural conversations.
 
 import re
 import os
-from typing import Dict, List, Tuple, Optional
+import functools
+import threading
+import queue
+import json
+import time
+from typing import Any, Dict, Final, Iterator, List, Set, Tuple, Optional
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
 
 # Try to import dotenv for .env file loading
 try:
@@ -19,18 +27,69 @@ except ImportError:
 
 # Try to import OpenAI - fall back to rule-based if not available
 try:
-    from openai import OpenAI
+    from openai import OpenAI, DefaultHttpxClient, NotFoundError
     LLM_AVAILABLE = True
 except ImportError:
     LLM_AVAILABLE = False
     print("Warning: OpenAI library not installed. Using rule-based mode. Install with: pip install openai")
 
+# The HTTP library the OpenAI SDK is built on (httpx2 from openai 3, httpx
+# before that), for configuring its connection pool
+if LLM_AVAILABLE:
+    try:
+        import httpx2 as openai_http
+    except ImportError:
+        import httpx as openai_http  # type: ignore[no-redef]
 
-class AIConsultant:
-    """AI system for primary care consultations with LLM integration."""
+# HTTP/2 for the OpenAI connection needs the optional h2 package
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Try to import llama-cpp-python - simple turns use the OpenAI API if not available
+try:
+    from llama_cpp import Llama
+    LOCAL_LLM_AVAILABLE = True
+except ImportError:
+    LOCAL_LLM_AVAILABLE = False
+
+# Try to import pyahocorasick - fall back to plain substring checks if not available
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+# Try to import PyArrow - bulk (vectorized) emergency detection is unavailable without it
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Commands users can type at any time
+EXIT_COMMANDS = frozenset({'exit', 'quit', 'bye', 'goodbye', 'q', 'stop', 'end', 'done'})
+HELP_COMMANDS = frozenset({'help', '?', 'commands'})
+
+# High fever (emergency temperature thresholds), compiled once at import
+# 105°F (40.5°C) or higher is a medical emergency
+_FEVER_RE = re.compile(
+    r'(?:10[5-9]|1[1-9]\d)\s*(?:f|degrees)'  # 105+°F or 105+ degrees
+    r'|4(?:0\.5|[1-9]\.?\d*)\s*c'          # 40.5°C, 41+°C
+)
+
+# Temperature reading such as "104f", "40.5 c" or "103°"
+_TEMP_RE = re.compile(r'(\d+\.?\d*)\s*[fc°]')
+
+
+class Detector:
+    """Stateless rule-based symptom detection, shared by every conversation."""
     
     # Emergency symptom keywords
-    EMERGENCY_KEYWORDS = [
+    EMERGENCY_KEYWORDS: Final[Tuple[str, ...]] = (
         'chest pain', 'chest pressure', 'heart attack', 'cardiac',
         'difficulty breathing', 'trouble breathing', 'shortness of breath', 'can\'t breathe', 
         'cannot breathe', 'choking', 'breathing problem', 'hard to breathe',
@@ -40,45 +99,481 @@ class AIConsultant:
         'severe headache', 'worst headache', 'sudden severe',
         'severe abdominal pain', 'severe stomach pain',
         'mental health crisis', 'suicidal', 'self harm'
-    ]
+    )
     
     # Emergency severity indicators
-    EMERGENCY_SEVERITY = ['severe', 'terrible', 'awful', 'worst', 'extreme', 'critical', 'emergency']
+    EMERGENCY_SEVERITY: Final[Tuple[str, ...]] = ('severe', 'terrible', 'awful', 'worst', 'extreme', 'critical', 'emergency')
+    
+    # Words combined with severity indicators to flag an emergency
+    BREATHING_WORDS: Final[Tuple[str, ...]] = ('breathing', 'breathe', 'breath')
+    PAIN_WORDS: Final[Tuple[str, ...]] = ('pain', 'hurting', 'hurt')
+    WORSENING_WORDS: Final[Tuple[str, ...]] = ('worse', 'worsening')
+    
+    # Fever mentions that trigger the temperature checks
+    FEVER_WORDS: Final[Tuple[str, ...]] = ('fever', 'temperature', 'temp')
+    HIGH_FEVER_PHRASES: Final[Tuple[str, ...]] = ('high fever', 'very high fever', 'dangerous fever')
     
     # Mild symptom keywords
-    MILD_KEYWORDS = [
+    MILD_KEYWORDS: Final[Tuple[str, ...]] = (
         'fatigue', 'tired', 'headache', 'mild', 'minor',
         'cold', 'cough', 'sneezing', 'runny nose',
         'mild pain', 'ache', 'sore',
         'digestive', 'upset stomach', 'mild nausea',
         'skin irritation', 'rash', 'itchy'
-    ]
+    )
+    
+    # Every keyword extract_symptoms can report, in the order it reports them
+    SYMPTOM_KEYWORDS: Final[Tuple[str, ...]] = EMERGENCY_KEYWORDS + MILD_KEYWORDS
+    
+    # Self-care recommendations, checked in priority order: the first bucket
+    # whose words appear in any symptom is used
+    RECOMMENDATIONS: Final[Tuple[Tuple[Tuple[str, ...], Tuple[str, str, str]], ...]] = (
+        (('headache', 'pain', 'ache'), (
+            "Rest in a quiet, dark room and try to stay hydrated with water",
+            "Consider over-the-counter pain relief like acetaminophen or ibuprofen, following package instructions",
+            "Apply a cool compress to your forehead or the area of discomfort for 15-20 minutes"
+        )),
+        (('fatigue', 'tired'), (
+            "Ensure you're getting 7-9 hours of sleep per night and maintain a regular sleep schedule",
+            "Stay hydrated throughout the day and eat balanced meals with plenty of fruits and vegetables",
+            "Take short breaks during the day and avoid overexertion - listen to your body's signals"
+        )),
+        (('cold', 'cough', 'sneezing', 'runny nose'), (
+            "Get plenty of rest and stay well-hydrated with water, herbal tea, or warm broth",
+            "Use a humidifier or take steamy showers to help with congestion, and consider saline nasal spray",
+            "Wash your hands frequently and cover your mouth when coughing to prevent spreading to others"
+        )),
+        (('digestive', 'stomach', 'nausea'), (
+            "Stick to bland, easy-to-digest foods like toast, rice, bananas, and avoid spicy or fatty foods",
+            "Stay hydrated with small sips of water or electrolyte drinks, and avoid large meals",
+            "Rest and avoid strenuous activity - if symptoms persist, consider over-the-counter remedies following package instructions"
+        )),
+    )
+    DEFAULT_RECOMMENDATIONS: Final[Tuple[str, str, str]] = (
+        "Get adequate rest and maintain a regular sleep schedule",
+        "Stay well-hydrated with water throughout the day",
+        "Monitor your symptoms and note any changes or worsening"
+    )
+    
+    def detect_emergency(self, text: str, check_severity: bool = True) -> bool:
+        """Detect if patient input suggests emergency symptoms."""
+        return self.detect_emergency_lower(text.lower(), check_severity)
+    
+    def detect_emergency_lower(self, text_lower: str, check_severity: bool = True) -> bool:
+        """detect_emergency for text the caller has already lowercased."""
+        mask, _ = _scan_keywords(text_lower)
+        
+        # Checks run cheapest-first: the fever regex only runs when the text
+        # mentions a fever or temperature, and the text is only tokenized for
+        # the severity checks once nothing else has matched.
+        
+        # Check for emergency keywords
+        if mask & _EMERGENCY:
+            return True
+        
+        # Check for high fever: an explicit high fever mention, or a temperature
+        # at or above the emergency threshold
+        if mask & _FEVER and (mask & _HIGH_FEVER or _FEVER_RE.search(text_lower)):
+            return True
+        
+        # Check for severe symptoms combined with emergency indicators:
+        # severe breathing issues, severe pain, or severe symptoms getting worse.
+        # Severity words are matched as whole words, so e.g. "severely" doesn't
+        # count; breathing and pain words match anywhere, so "hurts", "pains"
+        # and "breathlessness" still do.
+        if check_severity and mask & (_WORSENING | _BREATHING | _PAIN):
+            if not _SEVERITY_WORDS.isdisjoint(_TOKEN_RE.findall(text_lower)):
+                return True
+        
+        return False
+    
+    def detect_emergency_bulk(self, texts: "pa.ChunkedArray", check_severity: bool = True) -> "pa.ChunkedArray":
+        """Vectorized detect_emergency over a column of texts (requires PyArrow).
+        
+        Applies the same rules as detect_emergency using Arrow's regex kernels,
+        which is far faster than calling it row by row when classifying logged
+        conversations. Null texts are reported as not emergencies.
+        """
+        if not PYARROW_AVAILABLE:
+            raise RuntimeError("detect_emergency_bulk requires pyarrow. Install with: pip install pyarrow")
+        
+        lower = pc.utf8_lower(texts)
+        
+        def matches(pattern: str) -> "pa.ChunkedArray":
+            return pc.fill_null(pc.match_substring_regex(lower, pattern), False)
+        
+        # Check for emergency keywords
+        result = matches(_BULK_PATTERNS['emergency'])
+        
+        # Check for high fever
+        high_fever = pc.or_(matches(_BULK_PATTERNS['high_fever']), matches(_FEVER_RE.pattern))
+        result = pc.or_(result, pc.and_(matches(_BULK_PATTERNS['fever']), high_fever))
+        
+        # Check for severe symptoms combined with emergency indicators
+        if check_severity:
+            indicators = pc.or_(matches(_BULK_PATTERNS['worsening']), pc.or_(
+                matches(_BULK_PATTERNS['breathing']), matches(_BULK_PATTERNS['pain'])))
+            result = pc.or_(result, pc.and_(matches(_BULK_PATTERNS['severity']), indicators))
+        
+        return result
+    
+    def detect_mild_symptoms(self, text: str) -> bool:
+        """Detect if patient input suggests mild symptoms."""
+        return self.detect_mild_symptoms_lower(text.lower())
+    
+    def detect_mild_symptoms_lower(self, text_lower: str) -> bool:
+        """detect_mild_symptoms for text the caller has already lowercased."""
+        mask, _ = _scan_keywords(text_lower)
+        return bool(mask & _MILD)
+    
+    def extract_symptoms(self, text: str) -> List[str]:
+        """Extract symptom mentions from patient input."""
+        return self.extract_symptoms_lower(text.lower())
+    
+    def extract_symptoms_lower(self, text_lower: str) -> List[str]:
+        """extract_symptoms for text the caller has already lowercased."""
+        # Simple extraction - in production, use NLP
+        _, found = _scan_keywords(text_lower)
+        # Keep the keyword-list order callers rely on for symptoms[0]
+        return sorted((keyword for keyword in found if keyword in _SYMPTOM_ORDER),
+                      key=_SYMPTOM_ORDER.__getitem__)
     
-    def __init__(self, use_llm: bool = True, api_key: Optional[str] = None):
+    def get_recommendations(self, symptoms: List[str]) -> Tuple[str, str, str]:
+        """Generate appropriate self-care recommendations based on symptoms."""
+        # The highest-priority bucket any symptom falls into wins
+        rank = min((_SYMPTOM_RANKS[symptom] if symptom in _SYMPTOM_RANKS else _recommendation_rank(symptom)
+                    for symptom in symptoms), default=len(self.RECOMMENDATIONS))
+        if rank < len(self.RECOMMENDATIONS):
+            return self.RECOMMENDATIONS[rank][1]
+        return self.DEFAULT_RECOMMENDATIONS
+
+
+def _recommendation_rank(symptom: str) -> int:
+    """Index of the first recommendation bucket matching symptom (len if none)."""
+    symptom_lower = symptom.lower()
+    for rank, (words, _) in enumerate(Detector.RECOMMENDATIONS):
+        if any(word in symptom_lower for word in words):
+            return rank
+    return len(Detector.RECOMMENDATIONS)
+
+
+# Position of every symptom keyword in Detector.SYMPTOM_KEYWORDS
+_SYMPTOM_ORDER: Dict[str, int] = {keyword: i for i, keyword in enumerate(Detector.SYMPTOM_KEYWORDS)}
+
+# Recommendation bucket of every symptom extract_symptoms can return
+_SYMPTOM_RANKS: Dict[str, int] = {keyword: _recommendation_rank(keyword) for keyword in Detector.SYMPTOM_KEYWORDS}
+
+
+# Category bits reported by the keyword scan
+_EMERGENCY = 1 << 0
+_MILD = 1 << 1
+_WORSENING = 1 << 2
+_FEVER = 1 << 3
+_HIGH_FEVER = 1 << 4
+_BREATHING = 1 << 5
+_PAIN = 1 << 6
+
+# Severity indicators, matched against the text's tokens as whole words
+_SEVERITY_WORDS: Final = frozenset(Detector.EMERGENCY_SEVERITY)
+_TOKEN_RE = re.compile(r"[a-z']+")
+
+
+def _build_keyword_bits() -> Dict[str, int]:
+    """Map every keyword the detector looks for to the category bits it sets."""
+    keyword_bits: Dict[str, int] = {}
+    for bit, keywords in [
+        (_EMERGENCY, Detector.EMERGENCY_KEYWORDS),
+        (_MILD, Detector.MILD_KEYWORDS),
+        (_WORSENING, Detector.WORSENING_WORDS),
+        (_FEVER, Detector.FEVER_WORDS),
+        (_HIGH_FEVER, Detector.HIGH_FEVER_PHRASES),
+        (_BREATHING, Detector.BREATHING_WORDS),
+        (_PAIN, Detector.PAIN_WORDS),
+    ]:
+        for keyword in keywords:
+            keyword_bits[keyword] = keyword_bits.get(keyword, 0) | bit
+    return keyword_bits
+
+
+_KEYWORD_BITS = _build_keyword_bits()
+
+
+def _any_substring_pattern(keywords) -> str:
+    """Regex matching any of keywords anywhere in the text."""
+    return '|'.join(re.escape(keyword) for keyword in keywords)
+
+
+def _any_token_pattern(words) -> str:
+    """Regex matching any of words as a whole _TOKEN_RE token."""
+    return "(?:^|[^a-z'])(?:" + _any_substring_pattern(words) + ")(?:$|[^a-z'])"
+
+
+# Regexes (RE2 syntax, for Arrow's kernels) equivalent to the detect_emergency checks
+_BULK_PATTERNS: Final = {
+    'emergency': _any_substring_pattern(Detector.EMERGENCY_KEYWORDS),
+    'fever': _any_substring_pattern(Detector.FEVER_WORDS),
+    'high_fever': _any_substring_pattern(Detector.HIGH_FEVER_PHRASES),
+    'worsening': _any_substring_pattern(Detector.WORSENING_WORDS),
+    'severity': _any_token_pattern(Detector.EMERGENCY_SEVERITY),
+    'breathing': _any_substring_pattern(Detector.BREATHING_WORDS),
+    'pain': _any_substring_pattern(Detector.PAIN_WORDS),
+}
+
+
+def _build_keyword_automaton():
+    """Compile all keyword lists into one Aho-Corasick automaton.
+    
+    Each keyword maps to (category bits, keyword), so a single pass over the
+    text reports every match along with its categories.
+    """
+    if not AHOCORASICK_AVAILABLE:
+        return None
+    automaton = ahocorasick.Automaton()
+    for keyword, bits in _KEYWORD_BITS.items():
+        automaton.add_word(keyword, (bits, keyword))
+    automaton.make_automaton()
+    return automaton
+
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+
+def _scan_keywords(text_lower: str) -> Tuple[int, Set[str]]:
+    """Scan already-lowercased text once.
+    
+    Returns:
+        The OR of the category bits of every match, and the matched keywords
+    """
+    mask = 0
+    found = set()
+    if _KEYWORD_AUTOMATON is not None:
+        for _, (bits, keyword) in _KEYWORD_AUTOMATON.iter(text_lower):
+            mask |= bits
+            found.add(keyword)
+    else:
+        # Fallback: one substring check per keyword
+        for keyword, bits in _KEYWORD_BITS.items():
+            if keyword in text_lower:
+                mask |= bits
+                found.add(keyword)
+    return mask, found
+
+
+@functools.cache
+def _system_instructions() -> str:
+    """Load system instructions from SYSTEM_INSTRUCTIONS.md (read once per process)"""
+    try:
+        return Path(__file__).with_name('SYSTEM_INSTRUCTIONS.md').read_text(encoding='utf-8')
+    except FileNotFoundError:
+        # Fallback to embedded instructions
+        return """You are an AI primary care consultant conducting patient consultations. Your role is to assess symptoms, provide guidance for mild cases, and escalate emergencies appropriately.
+
+Always use "I understand" (never "I see" or "I hear") when acknowledging patient concerns.
+Before recommendations, ask: "What concerns you most about this?"
+After recommendations, end with: "How does this sound to you?"
+For pain: "That sounds really uncomfortable"
+For worry: "It's completely understandable that you're concerned about [specific symptom]"
+Never say "don't worry" - use "let's work through this together"
+No medical jargon - use lay terms (e.g., "high blood pressure" not "hypertension")
+Always include disclaimer: "I can provide guidance, but I cannot replace an in-person examination"
+"""
+
+
+@dataclass(slots=True)
+class TurnFacts:
+    """What a single patient message tells us about the assessment."""
+    severity: bool
+    timeline: bool
+    concerns: bool
+    worsening: bool
+
+
+# Whole words that mark each assessment fact in a patient message
+_STATE_SEVERITY_WORDS: Final = frozenset({'severe', 'terrible', 'awful', 'worst', 'extreme'})
+_TIMELINE_WORDS: Final = frozenset({'start', 'started', 'starting', 'starts', 'began', 'days', 'hours', 'weeks', 'ago'})
+_CONCERN_WORDS: Final = frozenset({'concern', 'concerns', 'concerned', 'concerning',
+                                   'worry', 'worries', 'worried', 'worrying'})
+_WORSENING_STATE_WORDS: Final = frozenset({'worse', 'worsening', 'worsened', 'worsens', 'deteriorating'})
+
+
+def _analyze_turn(text_lower: str) -> TurnFacts:
+    """Tokenize an already-lowercased message once and extract its assessment facts."""
+    tokens = set(_TOKEN_RE.findall(text_lower))
+    return TurnFacts(
+        severity=not tokens.isdisjoint(_STATE_SEVERITY_WORDS),
+        timeline=not tokens.isdisjoint(_TIMELINE_WORDS),
+        concerns=not tokens.isdisjoint(_CONCERN_WORDS),
+        worsening=not tokens.isdisjoint(_WORSENING_STATE_WORDS),
+    )
+
+
+@dataclass(slots=True)
+class ConversationState:
+    """Where a consultation stands and what the patient has told us so far."""
+    stage: str = 'greeting'
+    symptoms: List[str] = field(default_factory=list)
+    symptom_description: str = ''
+    timeline: Optional[str] = None
+    severity: Optional[str] = None
+    concerns: Optional[str] = None
+    assessed: bool = False
+    questions_asked: Set[str] = field(default_factory=set)
+    information_gathered: Dict[str, str] = field(default_factory=dict)
+
+
+def _approx_tokens(text: str) -> int:
+    """Rough token count: ~4 characters per token."""
+    return len(text) // 4
+
+
+class Session:
+    """Per-conversation state: assessment progress and LLM message history."""
+    
+    __slots__ = ('state', 'conversation_history', 'history_tokens', 'response_cache')
+    
+    # Number of recent non-emergency responses remembered per conversation
+    RESPONSE_CACHE_SIZE = 256
+    
+    # Bounds on the history sent with each request: message count (user/assistant
+    # pairs, so even) and approximate tokens
+    MAX_HISTORY_MESSAGES = 12
+    MAX_HISTORY_TOKENS = 3000
+    
+    def __init__(self) -> None:
+        self.state = ConversationState()
+        self.conversation_history: "deque[Dict[str, str]]" = deque()
+        # Running estimate for conversation_history, kept in step with it
+        self.history_tokens = 0
+        # Responses keyed by the conversation facts they depend on and the
+        # normalized input, least recently used first
+        self.response_cache: "OrderedDict[tuple, str]" = OrderedDict()
+    
+    def add_exchange(self, user_input: str, response: str) -> None:
+        """Append a user/assistant exchange, trimming the history once it exceeds its bounds.
+        
+        Trimming drops the older half of the history in one go (and then more
+        exchanges while it is still over MAX_HISTORY_TOKENS) rather than one
+        exchange per turn. Every trim changes the start of the history and so
+        misses the provider's prompt-prefix cache once, but the turns between
+        trims reuse the cached prefix. The cost is that the model sees anywhere
+        from half of MAX_HISTORY_MESSAGES up to all of them.
+        """
+        history = self.conversation_history
+        for entry in ({"role": "user", "content": user_input},
+                      {"role": "assistant", "content": response}):
+            history.append(entry)
+            self.history_tokens += _approx_tokens(entry['content'])
+        
+        if len(history) <= self.MAX_HISTORY_MESSAGES and self.history_tokens <= self.MAX_HISTORY_TOKENS:
+            return
+        
+        # Drop the older half, keeping whole user/assistant exchanges
+        for _ in range(len(history) // 4 * 2):
+            self.history_tokens -= _approx_tokens(history.popleft()['content'])
+        while history and self.history_tokens > self.MAX_HISTORY_TOKENS:
+            for _ in range(2):
+                self.history_tokens -= _approx_tokens(history.popleft()['content'])
+    
+    def response_cache_key(self, text_lower: str) -> tuple:
+        """Key for caching the response to text_lower at this point in the conversation.
+        
+        Includes everything the rule-based response depends on, plus the length
+        and last reply of the LLM history, which LLM responses depend on. Every
+        LLM answer extends the history, so in an LLM conversation a repeated
+        message misses; the hits come from rule-based conversations.
+        """
+        state = self.state
+        history = self.conversation_history
+        last_reply = history[-1]['content'] if history else None
+        return (state.stage, tuple(state.symptoms), state.timeline, state.concerns,
+                len(history), last_reply, ' '.join(text_lower.split()))
+    
+    def get_cached_response(self, key: tuple) -> Optional[str]:
+        """Return the cached response for key, if any."""
+        response = self.response_cache.get(key)
+        if response is not None:
+            self.response_cache.move_to_end(key)
+        return response
+    
+    def cache_response(self, key: tuple, response: str):
+        """Remember a response, evicting the least recently used beyond RESPONSE_CACHE_SIZE."""
+        self.response_cache[key] = response
+        self.response_cache.move_to_end(key)
+        if len(self.response_cache) > self.RESPONSE_CACHE_SIZE:
+            self.response_cache.popitem(last=False)
+
+
+class AIConsultant:
+    """AI system for primary care consultations with LLM integration."""
+    
+    __slots__ = ('detector', 'session', 'use_llm', 'api_key', 'client',
+                 'system_instructions', '_stable_prefix', '_local_llm', '_local_lock')
+    
+    # Chat model used for LLM responses (cost-effective)
+    MODEL = "gpt-4o-mini"
+    
+    # Canned replies for input that doesn't need a consultation (see quick_reply)
+    EMPTY_INPUT_REPLY: Final = "I understand you might be hesitant. Please feel free to share what's on your mind - I'm here to help."
+    EXIT_REPLY: Final = "I understand you're ending our conversation. Take care, and remember - if your symptoms worsen or you have concerns, please don't hesitate to seek medical attention. How does this sound to you?"
+    HELP_REPLY: Final = "I understand you'd like some help. You can type 'exit', 'quit', 'q', or 'bye' at any time to end our conversation. Otherwise, just describe your symptoms or concerns, and I'll help you work through them. How does this sound to you?"
+    
+    # Prefix of ids for batches answered entirely without the API (followed by
+    # the id of their uploaded inputs file)
+    LOCAL_BATCH_PREFIX = 'local-'
+    
+    # Follow-up messages up to this length can be answered by the local model
+    LOCAL_MAX_INPUT_CHARS = 200
+    
+    # Context window of the local model; requests are trimmed to fit it
+    LOCAL_CONTEXT_TOKENS = 8192
+    
+    # Tokens reserved for the reply, and per message for chat-template markup
+    MAX_RESPONSE_TOKENS = 500
+    LOCAL_MESSAGE_OVERHEAD_TOKENS = 8
+    
+    # Per-turn instruction added when the patient describes emergency symptoms
+    EMERGENCY_HINT = "IMPORTANT: The patient has described emergency symptoms (chest pain, difficulty breathing, severe pain, high fever 105°F/40.5°C or higher, stroke signs, etc.). You must follow the emergency protocol exactly: Use 'Based on what you've told me...' format, state 'This is beyond what I can safely assess remotely', and recommend immediate medical care. Do NOT provide self-care recommendations for emergencies."
+    
+    def __init__(self, use_llm: bool = True, api_key: Optional[str] = None,
+                 detector: Optional[Detector] = None, local_model_path: Optional[str] = None):
         """Initialize the AI consultant.
         
+        The consultant itself holds no per-conversation state, so one instance
+        can serve many concurrent conversations, each passing its own Session.
+        
         Args:
             use_llm: Whether to use LLM API (default: True)
             api_key: OpenAI API key (default: from OPENAI_API_KEY env var)
+            detector: Shared symptom detector (default: a new Detector)
+            local_model_path: Quantized GGUF model for simple turns (default: from
+                LOCAL_MODEL_PATH env var; none if unset)
         """
-        self.conversation_state = {
-            'stage': 'greeting',
-            'symptoms': [],
-            'symptom_description': '',
-            'timeline': None,
-            'severity': None,
-            'concerns': None,
-            'assessed': False,
-            'questions_asked': set(),
-            'information_gathered': {}
-        }
+        self.detector = detector or Detector()
+        # Conversation used when callers don't manage their own sessions (CLI)
+        self.session = Session()
         
         # LLM setup
         self.use_llm = use_llm and LLM_AVAILABLE
         self.api_key = api_key or os.getenv('OPENAI_API_KEY')
-        self.client = None
-        self.conversation_history = []
-        self.system_instructions = self._load_system_instructions()
+        self.client: Any = None
+        self.system_instructions = _system_instructions()
+        # Frozen so every request starts with byte-identical system prompt
+        self._stable_prefix = ({"role": "system", "content": self.system_instructions},)
+        self._local_llm: Any = None
+        # llama.cpp models are not safe to call from several threads at once
+        self._local_lock = threading.Lock()
+        
+        local_model_path = local_model_path or os.getenv('LOCAL_MODEL_PATH')
+        if use_llm and local_model_path:
+            if not LOCAL_LLM_AVAILABLE:
+                print("Warning: LOCAL_MODEL_PATH is set but llama-cpp-python is not installed. Install with: pip install llama-cpp-python")
+            else:
+                try:
+                    self._local_llm = Llama(model_path=local_model_path, n_ctx=self.LOCAL_CONTEXT_TOKENS,
+                                            n_threads=os.cpu_count(), verbose=False)
+                    print(f"✓ Local model enabled for simple turns ({os.path.basename(local_model_path)})")
+                except Exception as e:
+                    print(f"Warning: Failed to load local model: {e}")
         
         if self.use_llm:
             if not self.api_key:
@@ -94,107 +589,39 @@ class AIConsultant:
                         print("Falling back to rule-based mode.")
                         self.use_llm = False
                     else:
-                        self.client = OpenAI(api_key=self.api_key)
+                        # One keep-alive connection pool shared by every request made
+                        # through this consultant, so TLS handshakes are reused
+                        self.client = OpenAI(
+                            api_key=self.api_key,
+                            http_client=DefaultHttpxClient(
+                                http2=HTTP2_AVAILABLE,
+                                limits=openai_http.Limits(max_connections=100, max_keepalive_connections=20)
+                            )
+                        )
                         print("✓ LLM mode enabled (API key detected)")
                 except Exception as e:
                     print(f"Warning: Failed to initialize OpenAI client: {e}")
                     print("Falling back to rule-based mode.")
                     self.use_llm = False
     
-    def _load_system_instructions(self) -> str:
-        """Load system instructions from SYSTEM_INSTRUCTIONS.md"""
-        try:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            instructions_path = os.path.join(script_dir, 'SYSTEM_INSTRUCTIONS.md')
-            with open(instructions_path, 'r') as f:
-                return f.read()
-        except FileNotFoundError:
-            # Fallback to embedded instructions
-            return """You are an AI primary care consultant conducting patient consultations. Your role is to assess symptoms, provide guidance for mild cases, and escalate emergencies appropriately.
-
-Always use "I understand" (never "I see" or "I hear") when acknowledging patient concerns.
-Before recommendations, ask: "What concerns you most about this?"
-After recommendations, end with: "How does this sound to you?"
-For pain: "That sounds really uncomfortable"
-For worry: "It's completely understandable that you're concerned about [specific symptom]"
-Never say "don't worry" - use "let's work through this together"
-No medical jargon - use lay terms (e.g., "high blood pressure" not "hypertension")
-Always include disclaimer: "I can provide guidance, but I cannot replace an in-person examination"
-"""
-    
-    def detect_emergency(self, text: str, check_severity: bool = True) -> bool:
-        """Detect if patient input suggests emergency symptoms."""
-        text_lower = text.lower()
-        
-        # Check for emergency keywords
-        if any(keyword in text_lower for keyword in self.EMERGENCY_KEYWORDS):
-            return True
-        
-        # Check for high fever (emergency temperature thresholds)
-        # 105°F (40.5°C) or higher is a medical emergency
-        fever_patterns = [
-            r'10[5-9]\s*f',  # 105-109°F (emergency)
-            r'1[1-9]\d\s*f',  # 110+°F (emergency)
-            r'40\.5\s*c',  # 40.5°C (emergency)
-            r'4[1-2]\.?\d*\s*c',  # 41.0-42.9°C (emergency)
-            r'4[3-9]\.?\d*\s*c',  # 43+°C (emergency)
-            r'10[5-9]\s*degrees',  # 105-109 degrees (emergency)
-            r'1[1-9]\d\s*degrees',  # 110+ degrees (emergency)
-        ]
-        
-        if 'fever' in text_lower or 'temperature' in text_lower or 'temp' in text_lower:
-            for pattern in fever_patterns:
-                if re.search(pattern, text_lower):
-                    return True
-            # Also check for explicit high fever mentions
-            if any(phrase in text_lower for phrase in ['high fever', 'very high fever', 'dangerous fever']):
-                return True
-        
-        # Check for severe symptoms combined with emergency indicators
-        if check_severity:
-            has_severity = any(severity in text_lower for severity in self.EMERGENCY_SEVERITY)
-            has_breathing = any(breath in text_lower for breath in ['breathing', 'breathe', 'breath'])
-            has_pain = any(pain in text_lower for pain in ['pain', 'hurting', 'hurt'])
-            
-            # If user mentions severe breathing issues or severe pain
-            if has_severity and (has_breathing or has_pain):
-                return True
-            
-            # Check if symptoms are getting worse with severity
-            if has_severity and ('worse' in text_lower or 'worsening' in text_lower):
-                return True
-        
-        return False
-    
-    def detect_mild_symptoms(self, text: str) -> bool:
-        """Detect if patient input suggests mild symptoms."""
-        text_lower = text.lower()
-        return any(keyword in text_lower for keyword in self.MILD_KEYWORDS)
-    
-    def extract_symptoms(self, text: str) -> List[str]:
-        """Extract symptom mentions from patient input."""
-        symptoms = []
-        # Simple extraction - in production, use NLP
-        for keyword in self.EMERGENCY_KEYWORDS + self.MILD_KEYWORDS:
-            if keyword in text.lower():
-                symptoms.append(keyword)
-        return symptoms
-    
     def get_greeting(self) -> str:
         """Initial greeting message."""
         return """Hello, I'm here to help you with your health concerns today. I understand you're looking for some guidance about how you're feeling.
 
 What's bringing you in today? Please describe what you're experiencing."""
     
-    def handle_emergency(self, text: str) -> str:
+    def handle_emergency(self, text: str, session: Optional[Session] = None) -> str:
         """Handle emergency scenario with structured response."""
-        symptoms = self.extract_symptoms(text)
-        text_lower = text.lower()
+        return self._handle_emergency_lower(text, text.lower(), session or self.session)
+    
+    def _handle_emergency_lower(self, text: str, text_lower: str, session: Session) -> str:
+        """handle_emergency with the lowercased text already computed."""
+        symptoms = self.detector.extract_symptoms_lower(text_lower)
         
         # Determine symptom description - check fever first as it's common
         if 'fever' in text_lower or 'temperature' in text_lower or 'temp' in text_lower:
             # Extract temperature if mentioned
-            temp_match = re.search(r'(\d+\.?\d*)\s*[fc°]', text_lower)
+            temp_match = _TEMP_RE.search(text_lower)
             if temp_match:
                 temp = temp_match.group(1)
                 # Check if it's Fahrenheit or Celsius
@@ -230,45 +657,144 @@ I can provide guidance, but I cannot replace an in-person examination, especiall
 How does this sound to you? Do you have any questions about where to seek care?"""
         
         # Mark as emergency handled
-        self.conversation_state['stage'] = 'emergency_handled'
+        session.state.stage = 'emergency_handled'
         return response
     
-    def _get_llm_response(self, user_input: str, is_emergency: bool = False) -> Optional[str]:
-        """Get response from LLM API."""
-        if not self.use_llm or not self.client:
+    def _build_messages(self, user_input: str, session: Session, is_emergency: bool = False) -> List[Dict[str, str]]:
+        """Build the chat messages for one turn.
+        
+        Layout is [system prompt] + [committed history] + [per-turn hints] + [user
+        input]. The history is only appended to between the occasional trims
+        that drop its older half (see Session.add_exchange), so on most turns
+        the leading bytes are identical to the previous request's and the
+        provider's prompt-prefix cache keeps hitting.
+        """
+        # Per-turn context goes after the history so it never shifts the prefix
+        dynamic_suffix = []
+        if is_emergency:
+            dynamic_suffix.append({"role": "system", "content": self.EMERGENCY_HINT})
+        
+        return [*self._stable_prefix, *session.conversation_history, *dynamic_suffix,
+                {"role": "user", "content": user_input}]
+    
+    def _should_use_local(self, user_input: str, session: Session, is_emergency: bool = False) -> bool:
+        """Whether this turn is simple enough for the local model.
+        
+        Short, non-emergency follow-ups during the assessment are mostly
+        acknowledgements and clarifying questions; the opening description and
+        anything long still go to the OpenAI model.
+        """
+        return (self._local_llm is not None
+                and not is_emergency
+                and session.state.stage == 'assessment'
+                and len(user_input) <= self.LOCAL_MAX_INPUT_CHARS)
+    
+    def _llm_available(self, user_input: str, session: Session) -> bool:
+        """Whether a model (local or OpenAI) can answer this turn."""
+        return self._should_use_local(user_input, session) or bool(self.use_llm and self.client)
+    
+    def _local_messages(self, messages: List[Dict[str, str]]) -> Optional[List[Dict[str, str]]]:
+        """Fit a request into the local model's context window.
+        
+        Counts tokens with the model's own tokenizer and drops the oldest history
+        exchanges until the messages and the reply fit in LOCAL_CONTEXT_TOKENS.
+        Returns None if they don't fit even without any history.
+        """
+        def count(message: Dict[str, str]) -> int:
+            tokens = self._local_llm.tokenize(message['content'].encode('utf-8'), add_bos=False)
+            return len(tokens) + self.LOCAL_MESSAGE_OVERHEAD_TOKENS
+        
+        # Local turns are never emergencies, so there are no per-turn hints
+        system, history, user = messages[0], messages[1:-1], messages[-1]
+        budget = self.LOCAL_CONTEXT_TOKENS - self.MAX_RESPONSE_TOKENS
+        used = count(system) + count(user) + sum(count(message) for message in history)
+        while history and used > budget:
+            # Remove a whole user/assistant exchange at a time
+            used -= sum(count(message) for message in history[:2])
+            history = history[2:]
+        
+        if used > budget:
+            return None
+        return [system, *history, user]
+    
+    def _get_local_response(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Get a response from the local model, or None if it can't answer."""
+        try:
+            with self._local_lock:
+                local_messages = self._local_messages(messages)
+                if local_messages is None:
+                    return None
+                response = self._local_llm.create_chat_completion(
+                    messages=local_messages,
+                    temperature=0.7,
+                    max_tokens=self.MAX_RESPONSE_TOKENS
+                )
+            return response['choices'][0]['message']['content'].strip() or None
+        except Exception as e:
+            print(f"Error calling local model: {e}")
+            return None
+    
+    def _stream_local(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        """Stream a response from the local model, yielding text as it is generated.
+        
+        Generation runs on its own thread and hands text over through a queue,
+        so the model lock is held only while tokens are produced - never while
+        the caller is busy with them (e.g. writing them to a slow client).
+        """
+        chunks: "queue.Queue[Any]" = queue.Queue()
+        
+        def generate() -> None:
+            try:
+                with self._local_lock:
+                    local_messages = self._local_messages(messages)
+                    if local_messages is not None:
+                        for chunk in self._local_llm.create_chat_completion(
+                                messages=local_messages, temperature=0.7,
+                                max_tokens=self.MAX_RESPONSE_TOKENS, stream=True):
+                            delta = chunk['choices'][0]['delta'].get('content')
+                            if delta:
+                                chunks.put(delta)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                # End of stream
+                chunks.put(None)
+        
+        threading.Thread(target=generate, daemon=True).start()
+        while (item := chunks.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    def _get_llm_response(self, user_input: str, session: Session, is_emergency: bool = False) -> Optional[str]:
+        """Get response from the local model or the LLM API.
+        
+        Turns the local model can't answer (it failed, or the request doesn't
+        fit its context) go to the LLM API instead.
+        """
+        use_local = self._should_use_local(user_input, session, is_emergency)
+        if not use_local and (not self.use_llm or not self.client):
             return None
         
         try:
-            # Build conversation context
-            messages = [{"role": "system", "content": self.system_instructions}]
-            
-            # Add conversation history
-            for entry in self.conversation_history[-6:]:  # Last 6 exchanges for context
-                messages.append(entry)
-            
-            # Add current user input
-            messages.append({"role": "user", "content": user_input})
-            
-            # Add emergency context if needed
-            if is_emergency:
-                messages.append({
-                    "role": "system",
-                    "content": "IMPORTANT: The patient has described emergency symptoms (chest pain, difficulty breathing, severe pain, high fever 105°F/40.5°C or higher, stroke signs, etc.). You must follow the emergency protocol exactly: Use 'Based on what you've told me...' format, state 'This is beyond what I can safely assess remotely', and recommend immediate medical care. Do NOT provide self-care recommendations for emergencies."
-                })
-            
-            # Call OpenAI API
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",  # Using cost-effective model
-                messages=messages,
-                temperature=0.7,
-                max_tokens=500
-            )
+            messages = self._build_messages(user_input, session, is_emergency)
             
-            llm_response = response.choices[0].message.content.strip()
+            llm_response = self._get_local_response(messages) if use_local else None
+            if llm_response is None:
+                if not self.use_llm or not self.client:
+                    return None
+                
+                # Call OpenAI API
+                response = self.client.chat.completions.create(
+                    model=self.MODEL,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=self.MAX_RESPONSE_TOKENS
+                )
+                llm_response = response.choices[0].message.content.strip()
             
             # Update conversation history
-            self.conversation_history.append({"role": "user", "content": user_input})
-            self.conversation_history.append({"role": "assistant", "content": llm_response})
+            session.add_exchange(user_input, llm_response)
             
             return llm_response
             
@@ -276,112 +802,361 @@ How does this sound to you? Do you have any questions about where to seek care?"
             print(f"Error calling LLM API: {e}")
             return None
     
-    def _get_recommendations(self, symptoms: List[str]) -> List[str]:
-        """Generate appropriate self-care recommendations based on symptoms."""
-        symptom_str = ' '.join(symptoms).lower()
-        
-        if any(s in symptom_str for s in ['headache', 'pain', 'ache']):
-            return [
-                "Rest in a quiet, dark room and try to stay hydrated with water",
-                "Consider over-the-counter pain relief like acetaminophen or ibuprofen, following package instructions",
-                "Apply a cool compress to your forehead or the area of discomfort for 15-20 minutes"
-            ]
-        elif any(s in symptom_str for s in ['fatigue', 'tired']):
-            return [
-                "Ensure you're getting 7-9 hours of sleep per night and maintain a regular sleep schedule",
-                "Stay hydrated throughout the day and eat balanced meals with plenty of fruits and vegetables",
-                "Take short breaks during the day and avoid overexertion - listen to your body's signals"
-            ]
-        elif any(s in symptom_str for s in ['cold', 'cough', 'sneezing', 'runny nose']):
-            return [
-                "Get plenty of rest and stay well-hydrated with water, herbal tea, or warm broth",
-                "Use a humidifier or take steamy showers to help with congestion, and consider saline nasal spray",
-                "Wash your hands frequently and cover your mouth when coughing to prevent spreading to others"
-            ]
-        elif any(s in symptom_str for s in ['digestive', 'stomach', 'nausea']):
-            return [
-                "Stick to bland, easy-to-digest foods like toast, rice, bananas, and avoid spicy or fatty foods",
-                "Stay hydrated with small sips of water or electrolyte drinks, and avoid large meals",
-                "Rest and avoid strenuous activity - if symptoms persist, consider over-the-counter remedies following package instructions"
-            ]
-        else:
-            return [
-                "Get adequate rest and maintain a regular sleep schedule",
-                "Stay well-hydrated with water throughout the day",
-                "Monitor your symptoms and note any changes or worsening"
-            ]
-    
-    def process_input(self, user_input: str) -> str:
-        """Process user input and generate appropriate response."""
+    def _get_llm_response_stream(self, user_input: str, session: Session) -> Iterator[str]:
+        """Stream a response from the local model or the LLM API, yielding text as it arrives.
+        
+        If the local model fails before producing any text, the LLM API answers
+        instead. The exchange is added to the conversation history once the
+        stream ends.
+        """
+        use_local = self._should_use_local(user_input, session)
+        if not use_local and (not self.use_llm or not self.client):
+            return
+        
+        messages = self._build_messages(user_input, session)
+        parts = []
+        
+        if use_local:
+            try:
+                for text in self._stream_local(messages):
+                    parts.append(text)
+                    yield text
+            except Exception as e:
+                if parts:
+                    raise
+                print(f"Error calling local model: {e}")
+        
+        if not parts:
+            if not self.use_llm or not self.client:
+                return
+            
+            stream = self.client.chat.completions.create(
+                model=self.MODEL,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=self.MAX_RESPONSE_TOKENS,
+                stream=True
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        
+        # Update conversation history
+        session.add_exchange(user_input, ''.join(parts).strip())
+    
+    def _batch_local_response(self, user_input: str) -> Optional[str]:
+        """The response to a batch input that is answered without the API, if it is one.
+        
+        As in process_input, empty inputs get the empty-input reply and
+        emergencies the rule-based emergency response (safety-critical).
+        """
+        user_input = user_input.strip()
+        if not user_input:
+            return self.EMPTY_INPUT_REPLY
+        text_lower = user_input.lower()
+        if self.detector.detect_emergency_lower(text_lower, check_severity=True):
+            return self._handle_emergency_lower(user_input, text_lower, Session())
+        return None
+    
+    def submit_batch(self, inputs: List[str]) -> Optional[str]:
+        """Submit consultations to the OpenAI Batch API for offline processing.
+        
+        Each input is treated as the opening message of a new conversation. Batch
+        requests are billed at a discount and complete within 24 hours, so this is
+        meant for non-interactive work such as re-evaluating logged conversations.
+        
+        Empty inputs and emergencies are never sent to the LLM. Their responses
+        are recomputed by get_batch_results from a copy of the inputs uploaded
+        alongside the batch, so they don't depend on this process.
+        
+        Returns:
+            The batch id to poll with get_batch_results, or None if LLM mode is off
+        """
+        if not self.use_llm or not self.client:
+            return None
+        
+        inputs_file = self.client.files.create(
+            file=('consultation_inputs.json', json.dumps(inputs).encode('utf-8')),
+            purpose='user_data'
+        )
+        
+        lines = []
+        for i, user_input in enumerate(inputs):
+            if self._batch_local_response(user_input) is not None:
+                continue
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.MODEL,
+                    "messages": self._build_messages(user_input.strip(), Session()),
+                    "temperature": 0.7,
+                    "max_tokens": self.MAX_RESPONSE_TOKENS
+                }
+            }))
+        
+        if not lines:
+            # Nothing for the API to do - the inputs file is all get_batch_results needs
+            return self.LOCAL_BATCH_PREFIX + inputs_file.id
+        
+        batch_file = self.client.files.create(
+            file=('consultations.jsonl', '\n'.join(lines).encode('utf-8')),
+            purpose='batch'
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h',
+            metadata={'inputs_file_id': inputs_file.id}
+        )
+        return batch.id
+    
+    def get_batch_results(self, batch_id: str) -> Tuple[str, Optional[List[Optional[str]]]]:
+        """Check on a batch submitted with submit_batch.
+        
+        Returns:
+            The batch status, and once it is 'completed' the responses in input
+            order (None for any request that failed)
+        
+        Raises:
+            KeyError: If there is no such batch
+        """
+        if not self.use_llm or not self.client:
+            return 'failed', None
+        
+        inputs_file_id: Optional[str]
+        output_file_id: Optional[str] = None
+        try:
+            if batch_id.startswith(self.LOCAL_BATCH_PREFIX):
+                inputs_file_id = batch_id[len(self.LOCAL_BATCH_PREFIX):]
+                status = 'completed'
+            else:
+                batch = self.client.batches.retrieve(batch_id)
+                if batch.status != 'completed':
+                    return batch.status, None
+                inputs_file_id = (batch.metadata or {}).get('inputs_file_id')
+                status, output_file_id = batch.status, batch.output_file_id
+            if not inputs_file_id:
+                raise KeyError(batch_id)
+            inputs = json.loads(self.client.files.content(inputs_file_id).text)
+        except NotFoundError:
+            raise KeyError(batch_id)
+        
+        responses: List[Optional[str]] = [self._batch_local_response(user_input) for user_input in inputs]
+        if output_file_id:
+            for line in self.client.files.content(output_file_id).text.splitlines():
+                record = json.loads(line)
+                response = record.get('response') or {}
+                i = int(record['custom_id'])
+                # A local answer always wins over the LLM's (safety-critical)
+                if response.get('status_code') == 200 and responses[i] is None:
+                    message = response['body']['choices'][0]['message']['content']
+                    responses[i] = message.strip()
+        return status, responses
+    
+    def process_input_batch(self, inputs: List[str], poll_interval: float = 60) -> List[Optional[str]]:
+        """Run consultations through the Batch API and wait for the responses.
+        
+        Blocks until the batch finishes (up to its 24 hour window). Returns an
+        empty list if LLM mode is off, or Nones if the batch did not complete.
+        """
+        batch_id = self.submit_batch(inputs)
+        if batch_id is None:
+            return []
+        
+        while True:
+            status, responses = self.get_batch_results(batch_id)
+            if responses is not None:
+                return responses
+            if status in ('failed', 'expired', 'cancelled'):
+                print(f"Batch {batch_id} did not complete: {status}")
+                return [None] * len(inputs)
+            time.sleep(poll_interval)
+    
+    def quick_reply(self, user_input: str) -> Optional[str]:
+        """Canned reply for exit/help commands and empty input, or None.
+        
+        Lets callers answer these without touching the detector or the LLM.
+        """
+        command = user_input.strip().lower()
+        if not command:
+            return self.EMPTY_INPUT_REPLY
+        if command in EXIT_COMMANDS:
+            return self.EXIT_REPLY
+        if command in HELP_COMMANDS:
+            return self.HELP_REPLY
+        return None
+    
+    def process_input(self, user_input: str, session: Optional[Session] = None) -> str:
+        """Process user input and generate appropriate response.
+        
+        Args:
+            user_input: The patient's message
+            session: Conversation to continue (default: the consultant's own session)
+        """
+        session = session or self.session
         user_input = user_input.strip()
         
         if not user_input:
-            return "I understand you might be hesitant. Please feel free to share what's on your mind - I'm here to help."
+            return self.EMPTY_INPUT_REPLY
         
         # Always check for emergency first (safety-critical, rule-based)
-        is_emergency = self.detect_emergency(user_input, check_severity=True)
-        
-        # Also check if we have context that makes this an emergency
-        if not is_emergency and self.conversation_state.get('symptom_description'):
-            combined_text = self.conversation_state['symptom_description'] + ' ' + user_input
-            is_emergency = self.detect_emergency(combined_text, check_severity=True)
-            if is_emergency:
-                user_input = combined_text
+        text_lower = user_input.lower()
+        is_emergency, user_input, text_lower = self._check_emergency(user_input, text_lower, session)
         
         # Handle emergency with rule-based response (safety-critical)
         if is_emergency:
-            return self.handle_emergency(user_input)
+            return self._handle_emergency_lower(user_input, text_lower, session)
+        
+        # A message repeated at the same point in the conversation gets the same
+        # answer without another LLM call (emergencies are never cached)
+        cache_key = session.response_cache_key(text_lower)
+        cached = session.get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+        
+        response = None
         
         # Try LLM for non-emergency responses
-        if self.use_llm:
-            llm_response = self._get_llm_response(user_input, is_emergency=False)
-            if llm_response:
+        llm_attempted = self._llm_available(user_input, session)
+        if llm_attempted:
+            response = self._get_llm_response(user_input, session, is_emergency=False)
+            if response:
                 # Update conversation state based on user input
-                self._update_conversation_state(user_input)
-                return llm_response
+                self._update_conversation_state(user_input, text_lower, session)
         
         # Fall back to rule-based response
-        return self._rule_based_response(user_input)
+        if not response:
+            response = self._rule_based_response(user_input, text_lower, session)
+            if llm_attempted:
+                # Only a stand-in for the failed LLM call - let a repeat try it again
+                return response
+        
+        session.cache_response(cache_key, response)
+        return response
     
-    def _update_conversation_state(self, user_input: str):
-        """Update conversation state based on user input."""
+    def process_input_stream(self, user_input: str, session: Optional[Session] = None) -> Iterator[str]:
+        """Process user input, yielding the response in pieces as it is generated.
+        
+        LLM responses are yielded token by token; emergency and rule-based
+        responses are yielded whole. Joining the pieces gives the same response
+        process_input would return.
+        
+        If the LLM fails before yielding anything, the rule-based response is
+        yielded instead. If it fails partway through, the error is re-raised so
+        the caller can discard the partial response; the conversation state is
+        left as it was before the message.
+        """
+        session = session or self.session
+        user_input = user_input.strip()
+        
+        if not user_input:
+            yield self.EMPTY_INPUT_REPLY
+            return
+        
+        # Always check for emergency first (safety-critical, rule-based)
         text_lower = user_input.lower()
+        is_emergency, user_input, text_lower = self._check_emergency(user_input, text_lower, session)
+        
+        # Handle emergency with rule-based response (safety-critical)
+        if is_emergency:
+            yield self._handle_emergency_lower(user_input, text_lower, session)
+            return
+        
+        # Repeated messages are answered from the cache, as in process_input
+        cache_key = session.response_cache_key(text_lower)
+        cached = session.get_cached_response(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        # Try LLM for non-emergency responses
+        llm_attempted = self._llm_available(user_input, session)
+        if llm_attempted:
+            parts = []
+            try:
+                for delta in self._get_llm_response_stream(user_input, session):
+                    parts.append(delta)
+                    yield delta
+            except Exception as e:
+                print(f"Error calling LLM API: {e}")
+                if parts:
+                    # Part of a response is already out - don't let it pass for a whole one
+                    raise
+            if parts:
+                # The stream finished cleanly
+                self._update_conversation_state(user_input, text_lower, session)
+                session.cache_response(cache_key, ''.join(parts))
+                return
+        
+        # Fall back to rule-based response (cached only if the LLM wasn't tried)
+        response = self._rule_based_response(user_input, text_lower, session)
+        if not llm_attempted:
+            session.cache_response(cache_key, response)
+        yield response
+    
+    def _check_emergency(self, user_input: str, text_lower: str, session: Session) -> Tuple[bool, str, str]:
+        """Check the input, and the earlier symptom description with it, for emergencies.
         
-        if self.conversation_state['stage'] == 'greeting':
-            self.conversation_state['stage'] = 'assessment'
-            self.conversation_state['symptom_description'] = user_input
-            self.conversation_state['symptoms'] = self.extract_symptoms(user_input)
-            self.conversation_state['information_gathered']['initial_symptoms'] = user_input
+        Returns:
+            Whether it is an emergency, and the text (and its lowercased form) to
+            handle it with - the combined description if only that flagged it
+        """
+        if self.detector.detect_emergency_lower(text_lower, check_severity=True):
+            return True, user_input, text_lower
+        
+        # Also check if we have context that makes this an emergency
+        if session.state.symptom_description:
+            combined_text = session.state.symptom_description + ' ' + user_input
+            combined_lower = session.state.symptom_description.lower() + ' ' + text_lower
+            if self.detector.detect_emergency_lower(combined_lower, check_severity=True):
+                return True, combined_text, combined_lower
+        
+        return False, user_input, text_lower
+    
+    def _update_conversation_state(self, user_input: str, text_lower: str, session: Session):
+        """Update conversation state based on user input."""
+        
+        if session.state.stage == 'greeting':
+            # First user input - gather initial symptom description
+            session.state.stage = 'assessment'
+            session.state.symptom_description = user_input
+            session.state.symptoms = self.detector.extract_symptoms_lower(text_lower)
+            session.state.information_gathered['initial_symptoms'] = user_input
         
-        elif self.conversation_state['stage'] == 'assessment':
-            if any(sev in text_lower for sev in ['severe', 'terrible', 'awful', 'worst', 'extreme']):
-                self.conversation_state['severity'] = 'severe'
-                self.conversation_state['information_gathered']['severity'] = user_input
+        elif session.state.stage == 'assessment':
+            facts = _analyze_turn(text_lower)
             
-            if any(word in text_lower for word in ['started', 'began', 'start', 'days', 'hours', 'weeks', 'ago']):
-                self.conversation_state['timeline'] = user_input
-                self.conversation_state['information_gathered']['timeline'] = user_input
+            if facts.severity:
+                session.state.severity = 'severe'
+                session.state.information_gathered['severity'] = user_input
             
-            if any(word in text_lower for word in ['worse', 'worsening', 'getting worse', 'deteriorating']):
-                self.conversation_state['information_gathered']['progression'] = 'worsening'
+            if facts.timeline:
+                session.state.timeline = user_input
+                session.state.information_gathered['timeline'] = user_input
             
-            if 'concern' in text_lower or 'worry' in text_lower or 'worried' in text_lower:
-                self.conversation_state['concerns'] = user_input
-                self.conversation_state['information_gathered']['concerns'] = user_input
+            if facts.worsening:
+                session.state.information_gathered['progression'] = 'worsening'
+            
+            if facts.concerns:
+                session.state.concerns = user_input
+                session.state.information_gathered['concerns'] = user_input
     
-    def _rule_based_response(self, user_input: str) -> str:
+    def _rule_based_response(self, user_input: str, text_lower: str, session: Session) -> str:
         """Fallback rule-based response generation."""
+        stage = session.state.stage
+        
+        # Record what this turn tells us, then respond based on the updated state
+        self._update_conversation_state(user_input, text_lower, session)
+        
         # Handle conversation flow dynamically
-        if self.conversation_state['stage'] == 'greeting':
-            # First user input - gather initial symptom description
-            self.conversation_state['stage'] = 'assessment'
-            self.conversation_state['symptom_description'] = user_input
-            self.conversation_state['symptoms'] = self.extract_symptoms(user_input)
-            self.conversation_state['information_gathered']['initial_symptoms'] = user_input
-            
+        if stage == 'greeting':
             # Check if it's clearly mild
-            if self.detect_mild_symptoms(user_input) and not any(sev in user_input.lower() for sev in self.EMERGENCY_SEVERITY):
-                return f"""I understand you're experiencing {self.conversation_state['symptoms'][0] if self.conversation_state['symptoms'] else 'these symptoms'}. That sounds really uncomfortable. Let's work through this together.
+            if self.detector.detect_mild_symptoms_lower(text_lower) and not any(sev in text_lower for sev in self.detector.EMERGENCY_SEVERITY):
+                return f"""I understand you're experiencing {session.state.symptoms[0] if session.state.symptoms else 'these symptoms'}. That sounds really uncomfortable. Let's work through this together.
 
 When did this first start, and has it been getting better, worse, or staying the same?"""
             else:
@@ -389,40 +1164,22 @@ When did this first start, and has it been getting better, worse, or staying the
 
 Could you help me understand more about what you're feeling? When did this first start, and has it been getting better, worse, or staying the same?"""
         
-        elif self.conversation_state['stage'] == 'assessment':
-            # Update information gathered
-            text_lower = user_input.lower()
-            
-            # Extract severity
-            if any(sev in text_lower for sev in ['severe', 'terrible', 'awful', 'worst', 'extreme']):
-                self.conversation_state['severity'] = 'severe'
-                self.conversation_state['information_gathered']['severity'] = user_input
-            
-            # Extract timeline
-            if any(word in text_lower for word in ['started', 'began', 'start', 'days', 'hours', 'weeks', 'ago']):
-                self.conversation_state['timeline'] = user_input
-                self.conversation_state['information_gathered']['timeline'] = user_input
-            
-            # Extract concerns
-            if 'concern' in text_lower or 'worry' in text_lower or 'worried' in text_lower:
-                self.conversation_state['concerns'] = user_input
-                self.conversation_state['information_gathered']['concerns'] = user_input
-            
+        elif stage == 'assessment':
             # Check if we have enough information
-            has_timeline = self.conversation_state.get('timeline') is not None
-            has_symptoms = len(self.conversation_state.get('symptoms', [])) > 0
+            has_timeline = session.state.timeline is not None
+            has_symptoms = len(session.state.symptoms) > 0
             
             if has_timeline and has_symptoms:
                 # Provide recommendations
-                symptoms = self.conversation_state['symptoms']
-                recommendations = self._get_recommendations(symptoms)
+                symptoms = session.state.symptoms
+                recommendations = self.detector.get_recommendations(symptoms)
                 symptom_desc = symptoms[0] if symptoms else "these symptoms"
                 
                 response = f"""I understand you're experiencing {symptom_desc}. That sounds really uncomfortable. Let's work through this together.
 """
                 
-                if self.conversation_state.get('concerns'):
-                    concern_topic = self._extract_concern_topic(self.conversation_state['concerns'])
+                if session.state.concerns:
+                    concern_topic = self._extract_concern_topic(session.state.concerns)
                     response += f"\nIt's completely understandable that you're concerned about {concern_topic}.\n"
                 
                 response += f"""
@@ -438,14 +1195,14 @@ If this isn't improving in 3-5 days, please contact your primary care provider o
 
 How does this sound to you?"""
                 
-                self.conversation_state['stage'] = 'completed'
+                session.state.stage = 'completed'
                 return response
             
             # Still need more information
             if not has_timeline:
                 return """I understand. When did this first start, and has it been getting better, worse, or staying the same?"""
             else:
-                if not self.conversation_state.get('concerns'):
+                if not session.state.concerns:
                     return """I understand. What concerns you most about this?"""
         
         # Default response
@@ -453,7 +1210,7 @@ How does this sound to you?"""
     
     def _extract_concern_topic(self, text: str) -> str:
         """Extract the topic of concern from patient input."""
-        symptoms = self.extract_symptoms(text)
+        symptoms = self.detector.extract_symptoms(text)
         if symptoms:
             return symptoms[0]
         return "your symptoms"
@@ -481,28 +1238,23 @@ def main():
     print(consultant.get_greeting())
     print()
     
-    # Exit commands that users can use
-    exit_commands = ['exit', 'quit', 'bye', 'goodbye', 'q', 'stop', 'end', 'done']
-    
     while True:
         try:
             user_input = input("\nYou: ").strip()
             
-            # Check for exit commands
-            if user_input.lower() in exit_commands:
-                print("\nAI: I understand you're ending our conversation. Take care, and remember - if your symptoms worsen or you have concerns, please don't hesitate to seek medical attention. How does this sound to you?")
-                break
-            
-            # Check for help command
-            if user_input.lower() in ['help', '?', 'commands']:
-                print("\nAI: I understand you'd like some help. You can type 'exit', 'quit', 'q', or 'bye' at any time to end our conversation. Otherwise, just describe your symptoms or concerns, and I'll help you work through them. How does this sound to you?")
+            # Exit, help and empty input are answered without running the consultation
+            reply = consultant.quick_reply(user_input)
+            if reply is not None:
+                print(f"\nAI: {reply}")
+                if user_input.lower() in EXIT_COMMANDS:
+                    break
                 continue
             
             response = consultant.process_input(user_input)
             print(f"\nAI: {response}")
             
         except KeyboardInterrupt:
-            print("\n\nAI: I understand you're ending our conversation. Take care, and remember - if your symptoms worsen or you have concerns, please don't hesitate to seek medical attention. How does this sound to you?")
+            print(f"\n\nAI: {AIConsultant.EXIT_REPLY}")
             break
         except Exception as e:
             print(f"\nAI: I apologize, I encountered an issue. Please try rephrasing your concern. How does this sound to you?")
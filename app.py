@@ -3,16 +3,44 @@
 Flask web application for CareBot AI Primary Care Consultation System
 """
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
-from ai_consultant import AIConsultant
+import json
+import threading
+import uuid
+from collections import OrderedDict
+from ai_consultant import AIConsultant, Detector, Session, PYARROW_AVAILABLE
+
+if PYARROW_AVAILABLE:
+    import pyarrow.parquet as pq
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for API endpoints
 
-# Initialize the AI consultant
-consultant = AIConsultant(use_llm=True)
+# Shared, stateless detector and consultant - conversation state lives in Session objects
+DETECTOR = Detector()
+consultant = AIConsultant(use_llm=True, detector=DETECTOR)
+
+# Active conversations keyed by the session id the frontend sends back.
+# Kept in this process only; least recently used sessions are evicted first.
+MAX_SESSIONS = 10_000
+SESSIONS = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(session_id):
+    """Return the Session for session_id, creating it if needed."""
+    with _sessions_lock:
+        session = SESSIONS.get(session_id)
+        if session is None:
+            session = SESSIONS[session_id] = Session()
+            if len(SESSIONS) > MAX_SESSIONS:
+                SESSIONS.popitem(last=False)
+        else:
+            SESSIONS.move_to_end(session_id)
+        return session
+
 
 @app.route('/')
 def index():
@@ -25,19 +53,30 @@ def consult():
     try:
         data = request.get_json()
         
-        if not data or 'message' not in data:
+        if not isinstance(data, dict) or 'message' not in data:
             return jsonify({'error': 'Message is required'}), 400
         
+        if not isinstance(data['message'], str):
+            return jsonify({'error': 'Message must be a string'}), 400
+        
         user_message = data['message'].strip()
         
         if not user_message:
             return jsonify({'error': 'Message cannot be empty'}), 400
         
-        # Process the message through the AI consultant
-        response = consultant.process_input(user_message)
+        # Continue the caller's conversation, or start a new one
+        session_id = data.get('session_id') or uuid.uuid4().hex
+        if not isinstance(session_id, str):
+            return jsonify({'error': 'session_id must be a string'}), 400
+        
+        # Exit/help commands get a canned reply; everything else is a consultation
+        response = consultant.quick_reply(user_message)
+        if response is None:
+            response = consultant.process_input(user_message, get_session(session_id))
         
         return jsonify({
             'response': response,
+            'session_id': session_id,
             'success': True
         })
         
@@ -49,6 +88,118 @@ def consult():
             'success': False
         }), 500
 
+@app.route('/api/consult/stream', methods=['POST'])
+def consult_stream():
+    """Stream the consultation response to the frontend as server-sent events.
+    
+    Each event carries a JSON object: {"delta": ...} for every piece of the
+    response, then {"done": true, "session_id": ...} once it is complete. If
+    processing fails, an {"error": ..., "response": ...} event before "done"
+    carries the reply to show in place of whatever was streamed.
+    """
+    data = request.get_json(silent=True)
+    
+    if not isinstance(data, dict) or 'message' not in data:
+        return jsonify({'error': 'Message is required'}), 400
+    
+    if not isinstance(data['message'], str):
+        return jsonify({'error': 'Message must be a string'}), 400
+    
+    user_message = data['message'].strip()
+    
+    if not user_message:
+        return jsonify({'error': 'Message cannot be empty'}), 400
+    
+    # Continue the caller's conversation, or start a new one
+    session_id = data.get('session_id') or uuid.uuid4().hex
+    if not isinstance(session_id, str):
+        return jsonify({'error': 'session_id must be a string'}), 400
+    
+    # Exit/help commands get a canned reply; everything else is a consultation
+    quick_reply = consultant.quick_reply(user_message)
+    
+    def generate():
+        try:
+            if quick_reply is not None:
+                yield f"data: {json.dumps({'delta': quick_reply})}\n\n"
+            else:
+                for delta in consultant.process_input_stream(user_message, get_session(session_id)):
+                    yield f"data: {json.dumps({'delta': delta})}\n\n"
+        except Exception as e:
+            print(f"Error processing consultation: {e}")
+            # Replaces anything already streamed for this message
+            yield f"data: {json.dumps({'error': 'An error occurred while processing your request', 'response': 'I apologize, I encountered an issue processing your message. Please try rephrasing your concern or try again in a moment. How does this sound to you?'})}\n\n"
+        yield f"data: {json.dumps({'done': True, 'session_id': session_id})}\n\n"
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/consult/batch', methods=['POST'])
+def consult_batch():
+    """Submit many standalone consultations to the OpenAI Batch API."""
+    data = request.get_json()
+    
+    if not data or not isinstance(data.get('messages'), list) or not data['messages']:
+        return jsonify({'error': 'A non-empty list of messages is required'}), 400
+    
+    if not consultant.use_llm:
+        return jsonify({'error': 'Batch consultations require LLM mode'}), 503
+    
+    try:
+        batch_id = consultant.submit_batch([str(message).strip() for message in data['messages']])
+        return jsonify({'batch_id': batch_id, 'success': True}), 202
+    except Exception as e:
+        print(f"Error submitting batch: {e}")
+        return jsonify({'error': 'An error occurred while submitting the batch', 'success': False}), 500
+
+@app.route('/api/consult/batch/<batch_id>', methods=['GET'])
+def consult_batch_status(batch_id):
+    """Poll a batch; responses are included once it has completed."""
+    if not consultant.use_llm:
+        return jsonify({'error': 'Batch consultations require LLM mode'}), 503
+    
+    try:
+        status, responses = consultant.get_batch_results(batch_id)
+        return jsonify({'batch_id': batch_id, 'status': status, 'responses': responses, 'success': True})
+    except KeyError:
+        return jsonify({'error': f'Unknown batch {batch_id!r}', 'success': False}), 404
+    except Exception as e:
+        print(f"Error retrieving batch {batch_id}: {e}")
+        return jsonify({'error': 'An error occurred while retrieving the batch', 'success': False}), 500
+
+@app.route('/api/consult/eval', methods=['POST'])
+def consult_eval():
+    """Flag emergencies across a Parquet file of logged messages.
+    
+    Expects a multipart upload with the file under 'file'; the text column
+    defaults to 'message' and can be set with the 'column' form field.
+    """
+    if not PYARROW_AVAILABLE:
+        return jsonify({'error': 'Bulk evaluation requires pyarrow'}), 503
+    
+    if 'file' not in request.files:
+        return jsonify({'error': 'A Parquet file is required'}), 400
+    
+    column = request.form.get('column', 'message')
+    
+    try:
+        table = pq.read_table(request.files['file'], columns=[column])
+    except Exception as e:
+        print(f"Error reading evaluation file: {e}")
+        return jsonify({'error': f'Could not read column {column!r} from the uploaded Parquet file'}), 400
+    
+    try:
+        flags = DETECTOR.detect_emergency_bulk(table.column(column)).to_pylist()
+        return jsonify({
+            'total': len(flags),
+            'emergencies': sum(flags),
+            'emergency_flags': flags,
+            'success': True
+        })
+    except Exception as e:
+        print(f"Error evaluating messages: {e}")
+        return jsonify({'error': 'An error occurred while evaluating the messages', 'success': False}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check endpoint."""
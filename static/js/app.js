@@ -10,6 +10,7 @@ class CareBotApp {
         
         this.isProcessing = false;
         this.conversationStarted = false;
+        this.sessionId = null;
         
         this.init();
     }
@@ -97,8 +98,17 @@ class CareBotApp {
             // Show typing indicator
             this.showTypingIndicator();
             
-            // Send message to backend
-            const response = await this.sendMessage(message);
+            // Stream the response from the backend, showing it as it arrives
+            let messageContent = null;
+            const response = await this.sendMessage(message, (text) => {
+                if (!messageContent) {
+                    this.hideTypingIndicator();
+                    messageContent = this.addMessage('ai', text);
+                } else {
+                    messageContent.innerHTML = this.formatMessage(text);
+                    this.scrollToBottom();
+                }
+            });
             
             // Hide typing indicator
             this.hideTypingIndicator();
@@ -106,8 +116,12 @@ class CareBotApp {
             // Check if response indicates emergency
             const isEmergency = this.detectEmergency(response);
             
-            // Add AI response
-            this.addMessage('ai', response, isEmergency);
+            // Add AI response (or mark the streamed one as an emergency)
+            if (!messageContent) {
+                this.addMessage('ai', response, isEmergency);
+            } else if (isEmergency) {
+                messageContent.parentElement.classList.add('emergency');
+            }
             
             this.conversationStarted = true;
             
@@ -120,21 +134,54 @@ class CareBotApp {
         }
     }
     
-    async sendMessage(message) {
-        const response = await fetch('/api/consult', {
+    async sendMessage(message, onDelta) {
+        const response = await fetch('/api/consult/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ message: message }),
+            body: JSON.stringify({ message: message, session_id: this.sessionId }),
         });
         
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
         
-        const data = await response.json();
-        return data.response;
+        // Read server-sent events: each "data: {...}" line carries a piece of the response
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                break;
+            }
+            
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            
+            for (const event of events) {
+                if (!event.startsWith('data: ')) {
+                    continue;
+                }
+                const data = JSON.parse(event.slice('data: '.length));
+                this.sessionId = data.session_id || this.sessionId;
+                if (data.error) {
+                    // The response failed partway - replace what was shown so far
+                    console.error('Error:', data.error);
+                    text = data.response;
+                    onDelta(text);
+                } else if (data.delta) {
+                    text += data.delta;
+                    onDelta(text);
+                }
+            }
+        }
+        
+        return text;
     }
     
     detectEmergency(response) {
@@ -174,6 +221,8 @@ class CareBotApp {
         
         // Scroll to bottom
         this.scrollToBottom();
+        
+        return contentDiv;
     }
     
     formatMessage(content) {
@@ -243,6 +292,7 @@ function clearChat() {
         if (app) {
             app.loadInitialGreeting();
             app.conversationStarted = false;
+            app.sessionId = null;
         }
     }
 }